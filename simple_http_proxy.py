@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
     simple-http-proxy ( https://github.com/WengChaoxi/simple-http-proxy )
@@ -8,94 +8,256 @@
     :copyright: (c) 2021 by WengChaoxi.
     :license: MIT, see LICENSE for more details.
 """
-from __future__ import print_function
-
+import os
+import errno
+import sys
+import signal
 import socket
-import select
+import selectors
 import time
+from functools import lru_cache
+
+# 直接转发的HTTP请求方法
+_HTTP_METHODS = frozenset((b'GET', b'POST', b'PUT', b'DELETE', b'HEAD'))
+# 可使用TCP Fast Open的请求方法：随SYN发出的数据可能被重放，仅限幂等且无副作用的方法
+_FASTOPEN_METHODS = frozenset((b'GET', b'HEAD'))
+
+# CONNECT隧道建立成功的响应，按HTTP版本预先生成
+_CONNECT_OK = b'%s 200 Connection Established\r\nConnection: close\r\n\r\n'
+_CONNECT_OK_MSGS = {
+    b'HTTP/1.1': _CONNECT_OK % b'HTTP/1.1',
+    b'HTTP/1.0': _CONNECT_OK % b'HTTP/1.0',
+}
+
+_DNS_TTL = 60 # DNS解析结果缓存时间，单位s
+
+_ACCEPT_BATCH = 64 # 每次可读事件最多接受的连接数
+
+_MAX_HEADER_SIZE = 64*1024 # 请求头最大长度，超过后拒绝请求，避免单个客户端耗尽内存
+_HEADER_TOO_LARGE = b'HTTP/1.1 431 Request Header Fields Too Large\r\nConnection: close\r\n\r\n'
+_BAD_REQUEST = b'HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n' # 请求中缺少服务端地址时的回复
+
+_CONNECT_TIMEOUT = 5 # 与服务端建立连接的超时时间，单位s
+
+_ACCEPT_BACKOFF = 1 # 接受连接时资源耗尽（如文件描述符耗尽）后暂停接受连接的时间，单位s
+# 需暂停接受连接的错误：资源耗尽时监听套接字会持续可读，其余错误只影响单个连接
+_ACCEPT_BACKOFF_ERRNOS = frozenset((errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM))
+
+# Linux下的TCP_CORK，连续转发大量数据时暂缓发送不满MSS的报文段，取消后立即发出
+_TCP_CORK = getattr(socket, 'TCP_CORK', None)
+
+# TCP Fast Open客户端选项（Linux 4.11+），socket模块未导出该常量
+_TCP_FASTOPEN_CONNECT = getattr(socket, 'TCP_FASTOPEN_CONNECT', 30 if sys.platform.startswith('linux') else None)
+
+# Linux下使用splice经由管道在两个套接字间直接搬运数据，数据不经过用户态（python3.10+）
+_SPLICE = hasattr(os, 'splice')
+if _SPLICE:
+    _SPLICE_FLAGS = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
 
 def debug(tag, msg):
     print('[%s] %s' % (tag, msg))
 
+def raise_nofile_limit():
+    '''
+    将进程可打开文件描述符数量的软限制提升到硬限制
+
+    返回：当前软限制，不支持时返回None
+    '''
+    try:
+        import resource # 仅unix
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+@lru_cache(maxsize=1024)
+def _getaddrinfo(host, port, ttl_hash):
+    return socket.getaddrinfo(host, port)[0]
+
+def resolve(host, port):
+    '''
+    解析DNS，结果按(host, port)缓存，超过_DNS_TTL后重新解析
+
+    参数：host 主机
+    参数：port 端口
+    返回：(family, sockettype, proto, canonname, target_addr)
+    '''
+    return _getaddrinfo(host, port, int(time.time() // _DNS_TTL)) # 时间片变化后缓存键随之变化，旧结果自然淘汰
+
 class HttpRequestPacket(object):
     '''
     HTTP请求包
     '''
-    def __init__(self, data):
-        self.__parse(data)
+    __slots__ = ('req_line', 'method', 'req_uri', 'version', 'req_header', 'host', 'req_data') # 每个请求都会创建，省去实例__dict__
 
-    def __parse(self, data):
+    def __init__(self, data, end=None):
+        self.__parse(data, end)
+
+    def __parse(self, data, end=None):
         '''
         解析一个HTTP请求数据包
         GET http://test.wengcx.top/index.html HTTP/1.1\r\nHost: test.wengcx.top\r\nProxy-Connection: keep-alive\r\nCache-Control: max-age=0\r\n\r\n
         
-        参数：data 原始数据
+        参数：data 原始数据，bytes或bytearray
+        参数：end 请求头与请求数据的分隔位置，调用方已查找过时传入，避免重复扫描
         '''
-        i0 = data.find(b'\r\n') # 请求行与请求头的分隔位置
-        i1 = data.find(b'\r\n\r\n') # 请求头与请求数据的分隔位置
+        i1 = data.find(b'\r\n\r\n') if end is None else end # 请求头与请求数据的分隔位置
+        i0 = data.find(b'\r\n', 0, i1+2) # 请求行与请求头的分隔位置
+        mv = memoryview(data) # 请求头、请求数据以memoryview引用原始数据，不再拷贝
     
         # 请求行 Request-Line
-        self.req_line = data[:i0]
+        self.req_line = bytes(mv[:i0])
         self.method, self.req_uri, self.version = self.req_line.split() # 请求行由method、request uri、version组成
         
         # 请求头域 Request Header Fields
-        self.req_header = data[i0+2:i1]
-        self.headers = {}
-        for header in self.req_header.split(b'\r\n'):
-            k, v = header.split(b': ')
-            self.headers[k] = v
-        self.host = self.headers.get(b'Host')
+        self.req_header = mv[i0+2:i1]
+        # 仅需Host字段，直接在请求头范围内查找，无需逐个拆分请求头
+        h = data.find(b'\r\nHost:', i0, i1)
+        if h == -1:
+            self.host = None
+        else:
+            self.host = bytes(mv[h+7:data.find(b'\r\n', h+2)]).strip()
         
         # 请求数据
-        self.req_data = data[i1+4:]
+        self.req_data = mv[i1+4:]
 
 class SimpleHttpProxy(object):
     '''
     简单的HTTP代理
 
     客户端(client) <=> 代理端(proxy) <=> 服务端(server)
+
+    单线程事件循环：所有套接字均为非阻塞，统一注册到selectors.DefaultSelector（Linux下为epoll）中，
+    按套接字所处阶段（接受连接、读取请求、转发数据）分派处理
     '''
-    def __init__(self, host='0.0.0.0', port=8080, listen=10, bufsize=8, delay=1):
+    def __init__(self, host='0.0.0.0', port=8080, listen=socket.SOMAXCONN, bufsize=64, nodelay=True, sockbuf=0, fastopen=False, workers=1):
         '''
         初始化代理套接字，用于与客户端、服务端通信
 
         参数：host 监听地址，默认0.0.0.0，代表本机任意ipv4地址
         参数：port 监听端口，默认8080
-        参数：listen 监听客户端数量，默认10
-        参数：bufsize 数据传输缓冲区大小，单位kb，默认8kb
-        参数：delay 数据转发延迟，单位ms，默认1ms
+        参数：listen 监听客户端数量，默认socket.SOMAXCONN
+        参数：bufsize 数据传输缓冲区大小，单位kb，默认64kb
+        参数：nodelay 是否禁用Nagle算法（TCP_NODELAY），默认True，小数据包立即发出
+        参数：sockbuf 内核套接字收发缓冲区大小（SO_RCVBUF/SO_SNDBUF），单位kb，默认0，保持内核的缓冲区自动调节；
+                设置后自动调节关闭，且实际大小受net.core.rmem_max、net.core.wmem_max限制，
+                仅在已调大这两项时用于高延迟链路（如12288kb以满足带宽时延积）
+        参数：fastopen 是否对GET、HEAD请求的上游连接启用TCP Fast Open，默认False，
+                再次连接同一服务端时请求数据随SYN发出，省去一次握手往返；SYN中的数据可能被重放，故不用于其他方法；
+                需内核net.ipv4.tcp_fastopen开启客户端支持
+        参数：workers 工作进程数量，默认1；大于1时各进程通过SO_REUSEPORT监听同一端口，由内核分发连接，为0时取CPU核数
         '''
-        self.socket_proxy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket_proxy.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # 将SO_REUSEADDR标记为True, 当socket关闭后，立刻回收该socket的端口
-        self.socket_proxy.bind((host, port))
-        self.socket_proxy.listen(listen)
+        if not workers:
+            workers = os.cpu_count() or 1
+        if workers > 1 and not hasattr(os, 'fork'):
+            workers = 1 # 不支持fork的平台（如Windows）只能单进程运行
+        self.workers = workers
+
+        self.address = (host, port)
+        self.backlog = listen
+        self.socket_sndrcv_bufsize = sockbuf*1024
+        self.selector = selectors.DefaultSelector() # 先于监听套接字创建，绑定失败时__del__仍可正常清理
+        self.__listen()
 
         self.socket_recv_bufsize = bufsize*1024
-        self.delay = delay/1000.0
+        self.nodelay = nodelay
+        self.fastopen = fastopen and _TCP_FASTOPEN_CONNECT is not None
+
+        nofile = raise_nofile_limit() # 每个连接占用2个套接字及splice管道，单个事件循环需要大量文件描述符
+        self.socket_peers = {} # fd -> 对端套接字
+        self.send_buffers = {} # fd -> 等待发往该套接字的数据
+        self.socket_eof = set() # 已读到EOF的fd
+        self.socket_events = {} # fd -> 已向selector注册的事件，避免每次调整前查询selector
+        self.req_buffers = {} # fd -> 已接收但尚不完整的请求头
+        self.pipes = {} # fd -> 用于splice转发到该套接字的管道(r, w)
+        self.pipe_sizes = {} # fd -> 管道中等待发往该套接字的数据量
+        # 接收数据的预分配缓冲区，由事件循环中的所有连接共用（单线程，数据在下次接收前已发出或拷贝）
+        self.recv_buffer = bytearray(self.socket_recv_bufsize)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.accept_resume = None # 暂停接受连接时，恢复接受的时刻
+        self.connecting = {} # fd -> [正在连接的服务端套接字, 超时时刻, 连接建立后发给客户端的数据（TCP Fast Open延迟握手时为None）]
 
         debug('info', 'bind=%s:%s' % (host, port))
-        debug('info', 'listen=%s' % listen)
-        debug('info', 'bufsize=%skb, delay=%sms' % (bufsize, delay))
+        debug('info', 'listen=%s, nofile=%s, workers=%s' % (listen, nofile, workers))
+        debug('info', 'bufsize=%skb, sockbuf=%s, nodelay=%s, fastopen=%s' % (bufsize, '%skb' % sockbuf if sockbuf else 'auto', nodelay, self.fastopen))
 
     def __del__(self):
+        self.selector.close()
         self.socket_proxy.close()
+
+    def __listen(self):
+        '''
+        创建代理套接字并开始监听
+        '''
+        self.socket_proxy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket_proxy.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # 将SO_REUSEADDR标记为True, 当socket关闭后，立刻回收该socket的端口
+        if self.workers > 1:
+            self.socket_proxy.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # 各工作进程分别监听同一端口，各自拥有接受队列
+        self.__setsockbuf(self.socket_proxy) # 需在listen前设置，以便协商合适的TCP窗口扩大因子
+        self.socket_proxy.bind(self.address)
+        self.socket_proxy.listen(self.backlog)
+        self.socket_proxy.setblocking(False)
+
+    def __setsockbuf(self, sock):
+        '''
+        设置内核套接字收发缓冲区大小，实际大小受net.core.rmem_max、net.core.wmem_max限制
+
+        参数：sock 套接字
+        '''
+        if self.socket_sndrcv_bufsize:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_sndrcv_bufsize)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_sndrcv_bufsize)
+
+    def __setsockopt(self, sock):
+        '''
+        设置客户端、服务端连接套接字选项
+
+        参数：sock 套接字
+        '''
+        if self.nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # 禁用Nagle算法，避免小数据包（如CONNECT响应）被延迟发送
+        self.__setsockbuf(sock)
     
-    def __connect(self, host, port):
+    def __connect(self, host, port, fastopen=False):
         '''
         解析DNS得到套接字地址并与之建立连接
 
         参数：host 主机
         参数：port 端口
-        返回：与目标主机建立连接的套接字
+        参数：fastopen 是否使用TCP Fast Open，启用后connect立即返回，握手推迟到首次发送数据时进行
+        返回：与目标主机建立连接的非阻塞套接字，连接尚未完成时记录在self.connecting中，由事件循环等待其完成
         '''
-        # 解析DNS获取对应协议簇、socket类型、目标地址
+        # 解析DNS获取对应协议簇、socket类型、目标地址，同一主机的解析结果会被缓存
         # getaddrinfo -> [(family, sockettype, proto, canonname, target_addr),]
-        (family, sockettype, _, _, target_addr) = socket.getaddrinfo(host, port)[0]
+        (family, sockettype, _, _, target_addr) = resolve(host, port)
         
         tmp_socket = socket.socket(family, sockettype)
-        tmp_socket.setblocking(0)
-        tmp_socket.settimeout(5)
-        tmp_socket.connect(target_addr)
+        try:
+            self.__setsockopt(tmp_socket)
+            if fastopen:
+                try:
+                    tmp_socket.setsockopt(socket.IPPROTO_TCP, _TCP_FASTOPEN_CONNECT, 1)
+                except OSError:
+                    pass # 内核不支持，使用普通握手
+            tmp_socket.setblocking(False)
+            try:
+                tmp_socket.connect(target_addr)
+                if fastopen:
+                    # 已有Fast Open cookie时connect立即返回，握手推迟到首次发送，同样需要超时控制；
+                    # 首次发送后套接字在握手完成时才变为可写
+                    self.connecting[tmp_socket.fileno()] = [tmp_socket, time.monotonic() + _CONNECT_TIMEOUT, None]
+            except BlockingIOError:
+                # 连接进行中，不阻塞事件循环，待套接字可写时检查连接结果
+                self.connecting[tmp_socket.fileno()] = [tmp_socket, time.monotonic() + _CONNECT_TIMEOUT, b'']
+        except OSError:
+            tmp_socket.close() # 尚未与客户端配对，需在此关闭
+            raise
         return tmp_socket
          
     def __proxy(self, socket_client):
@@ -104,125 +266,473 @@ class SimpleHttpProxy(object):
 
         参数：socket_client 代理端与客户端之间建立的套接字
         '''
-        # 接收客户端请求数据
-        req_data = socket_client.recv(self.socket_recv_bufsize)
-        if req_data == b'':
+        # 接收客户端请求数据，请求头可能分多次到达，需累积至读到空行为止
+        fd = socket_client.fileno()
+        buf = self.req_buffers.setdefault(fd, bytearray())
+        n = socket_client.recv_into(self.recv_buffer)
+        if n == 0:
+            self.__close(socket_client)
             return
+        start = max(len(buf) - 3, 0) # 只需从新数据处（及可能跨越两次接收的3个字节）开始查找空行
+        buf += self.recv_view[:n]
+        end = buf.find(b'\r\n\r\n', start)
+        if end == -1:
+            if len(buf) > _MAX_HEADER_SIZE:
+                try:
+                    socket_client.send(_HEADER_TOO_LARGE) # 尽力通知客户端，发不出去也直接关闭
+                except OSError:
+                    pass
+                self.__close(socket_client)
+            return # 请求头尚未接收完整，等待下次可读
+        req_data = self.req_buffers.pop(fd)
 
         # 解析http请求数据
-        http_packet = HttpRequestPacket(req_data)
+        http_packet = HttpRequestPacket(req_data, end)
 
-        # 获取服务端host、port
-        if b':' in http_packet.host:
-            server_host, server_port = http_packet.host.split(b':')
+        # 获取服务端host、port：CONNECT请求取请求行中的host:port，绝对URI取其中的主机部分，否则取Host请求头
+        uri = http_packet.req_uri
+        j = -1 # 绝对URI中路径的起始位置，非绝对URI时为-1
+        if http_packet.method == b'CONNECT':
+            host = uri
         else:
-            server_host, server_port = http_packet.host, 80
-
-        # 修正http请求数据
-        tmp = b'%s//%s' % (http_packet.req_uri.split(b'//')[0], http_packet.host)
-        req_data = req_data.replace(tmp, b'')
+            host = http_packet.host
+            i = uri.find(b'://')
+            if i != -1 and not uri.startswith(b'/') and b'/' not in uri[:i]: # 仅处理绝对URI，路径形式的URI原样转发
+                # 路径从主机后第一个'/'、'?'或'#'开始
+                j = min([k for k in (uri.find(c, i+3) for c in (b'/', b'?', b'#')) if k != -1] or [len(uri)])
+                host = uri[i+3:j].rpartition(b'@')[2] # 去掉可能存在的用户信息
+        if not host:
+            try:
+                socket_client.send(_BAD_REQUEST) # 无法确定服务端，尽力通知客户端后关闭
+            except OSError:
+                pass
+            self.__close(socket_client)
+            return
+        if b':' in host:
+            server_host, server_port = host.split(b':')
+        else:
+            server_host, server_port = host, 80
 
         # HTTP
-        if http_packet.method in [b'GET', b'POST', b'PUT', b'DELETE', b'HEAD']:
-            socket_server = self.__connect(server_host, server_port) # 建立连接
-            socket_server.send(req_data) # 将客户端请求数据发给服务端
+        if http_packet.method in _HTTP_METHODS:
+            # 修正http请求数据：将请求行中的绝对URI改为路径，只重写请求行，请求头与请求数据原样转发
+            if j != -1:
+                # 无路径时补'/'并保留查询串、片段
+                path = uri[j:] if uri[j:j+1] == b'/' else b'/' + uri[j:]
+                req_data = b''.join((http_packet.method, b' ', path, b' ', http_packet.version,
+                    memoryview(req_data)[len(http_packet.req_line):]))
+
+            socket_server = self.__connect(server_host, server_port, self.fastopen and http_packet.method in _FASTOPEN_METHODS) # 建立连接
+            self.__pair(socket_client, socket_server)
+            self.__write(socket_server, req_data) # 将客户端请求数据发给服务端
 
         # HTTPS，会先通过CONNECT方法建立TCP连接
         elif http_packet.method == b'CONNECT':
             socket_server = self.__connect(server_host, server_port) # 建立连接
+            self.__pair(socket_client, socket_server)
+
+            success_msg = _CONNECT_OK_MSGS.get(http_packet.version)
+            if success_msg is None:
+                success_msg = _CONNECT_OK % http_packet.version
+            if socket_server.fileno() in self.connecting:
+                self.connecting[socket_server.fileno()][2] = success_msg # 连接建立后再通知客户端
+            else:
+                self.__write(socket_client, success_msg) # 完成连接，通知客户端
+            # 客户端得知连接建立后发送的真实请求数据，由事件循环转发给服务端
 
-            success_msg = b'%s %d Connection Established\r\nConnection: close\r\n\r\n'\
-                %(http_packet.version, 200)
-            socket_client.send(success_msg) # 完成连接，通知客户端
-            
-            # 客户端得知连接建立，会将真实请求数据发送给代理服务端
-            req_data = socket_client.recv(self.socket_recv_bufsize) # 接收客户端真实数据
-            socket_server.send(req_data) # 将客户端真实请求数据发给服务端
+        else:
+            self.__close(socket_client)
+            return
 
-        # 使用select异步处理，不阻塞
-        self.__nonblocking(socket_client, socket_server)
+        self.__update(socket_client)
 
-    def __nonblocking(self, socket_client, socket_server):
+    def __pair(self, socket_client, socket_server):
         '''
-        使用select实现异步处理数据
+        将客户端与服务端套接字配对，之后双方数据由__forward转发
 
         参数：socket_client 代理端与客户端之间建立的套接字
         参数：socket_server 代理端与服务端之间建立的套接字
         '''
-        _rlist = [socket_client, socket_server]
-        is_recv = True
-        while is_recv:
+        self.__watch(socket_client, 0) # 请求已读取，解除handle_client_request的注册
+        for sock, peer in ((socket_client, socket_server), (socket_server, socket_client)):
+            self.socket_peers[sock.fileno()] = peer
+            self.send_buffers[sock.fileno()] = bytearray()
+            if _SPLICE:
+                try:
+                    self.pipes[sock.fileno()] = os.pipe()
+                    self.pipe_sizes[sock.fileno()] = 0
+                except OSError:
+                    pass # 文件描述符不足时，该方向退回recv/send转发
+
+    def __write(self, sock, data):
+        '''
+        向套接字发送数据，未能立即发出的部分暂存于发送缓冲区，待可写时继续发送
+
+        参数：sock 目标套接字
+        参数：data 数据
+        '''
+        buf = self.send_buffers[sock.fileno()]
+        pending_connect = self.connecting.get(sock.fileno())
+        if not buf and (pending_connect is None or pending_connect[2] is None): # Fast Open延迟握手需由首次发送触发
             try:
-                # rlist, wlist, elist = select.select(_rlist, _wlist, _elist, [timeout])
-                # 参数1：当列表_rlist中的文件描述符fd状态为readable时，fd将被添加到rlist中
-                # 参数2：当列表_wlist中存在文件描述符fd时，fd将被添加到wlist
-                # 参数3：当列表_xlist中的文件描述符fd发生错误时，fd将被添加到elist
-                # 参数4：超时时间timeout
-                #  1) 当timeout==None时，select将一直阻塞，直到监听的文件描述符fd发生变化时返回
-                #  2) 当timeout==0时，select不会阻塞，无论文件描述符fd是否有变化，都立刻返回
-                #  3) 当timeout>0时，若文件描述符fd无变化，select将被阻塞timeout秒再返回
-                rlist, _, elist = select.select(_rlist, [], [], 2)
-                if elist:
-                    break
-                for tmp_socket in rlist:
-                    is_recv = True
-                    # 接收数据
-                    data = tmp_socket.recv(self.socket_recv_bufsize)
-                    if data == b'':
-                        is_recv = False
-                        continue
-                    
-                    # socket_client状态为readable, 当前接收的数据来自客户端
-                    if tmp_socket is socket_client: 
-                        socket_server.send(data) # 将客户端请求数据发往服务端
-                        # debug('proxy', 'client -> server')
-
-                    # socket_server状态为readable, 当前接收的数据来自服务端
-                    elif tmp_socket is socket_server:
-                        socket_client.send(data) # 将服务端响应数据发往客户端
-                        # debug('proxy', 'client <- server')
-                        
-                time.sleep(self.delay) # 适当延迟以降低CPU占用
-            except Exception as e:
-                break
+                n = sock.send(data)
+            except BlockingIOError:
+                n = 0
+            data = memoryview(data)[n:]
+        buf += data
+
+    def __forward(self, sock, mask):
+        '''
+        转发数据：可写时发送缓冲区数据，可读时接收数据并发往对端
+
+        参数：sock 就绪的套接字
+        参数：mask 就绪事件
+        '''
+        fd = sock.fileno()
+        if fd in self.connecting:
+            self.__connected(sock)
+        if mask & selectors.EVENT_WRITE:
+            self.__flush(sock)
+        if mask & selectors.EVENT_READ:
+            peer = self.socket_peers[fd]
+            if peer.fileno() in self.pipes:
+                if self.__splice(sock, peer) == 0:
+                    self.socket_eof.add(fd)
+            elif self.__relay(sock, peer) == 0:
+                self.socket_eof.add(fd)
+        self.__update(sock)
+
+    def __connected(self, sock):
+        '''
+        正在连接的服务端套接字变为可写，检查连接结果
+
+        参数：sock 服务端套接字
+        '''
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise OSError(err, os.strerror(err)) # 由事件循环关闭这一对套接字
+        _, _, msg = self.connecting.pop(sock.fileno())
+        if msg:
+            self.__write(self.socket_peers[sock.fileno()], msg)
+
+    def __expire(self):
+        '''
+        关闭连接超时的套接字，到时恢复接受连接
+
+        返回：距离下一个超时时刻的秒数，无需等待时返回None
+        '''
+        if not self.connecting and self.accept_resume is None:
+            return None
+        now = time.monotonic()
+        deadlines = []
+        if self.accept_resume is not None:
+            if self.accept_resume <= now:
+                self.accept_resume = None
+                self.selector.register(self.socket_proxy, selectors.EVENT_READ, self.__accept)
+            else:
+                deadlines.append(self.accept_resume)
+        for sock, deadline, _ in list(self.connecting.values()):
+            if deadline <= now:
+                self.__close(sock)
+        deadlines.extend(deadline for _, deadline, _ in self.connecting.values())
+        return max(min(deadlines) - now, 0) if deadlines else None
+
+    def __flush(self, sock):
+        '''
+        继续发送等待发往套接字的数据，先发送缓冲区中的数据，再发送管道中的数据
+
+        参数：sock 可写的套接字
+        '''
+        fd = sock.fileno()
+        buf = self.send_buffers[fd]
+        if buf:
+            n = sock.send(buf)
+            del buf[:n]
+        if not buf and self.pipe_sizes.get(fd):
+            try:
+                n = os.splice(self.pipes[fd][0], fd, self.pipe_sizes[fd], flags=_SPLICE_FLAGS)
+            except BlockingIOError:
+                n = 0
+            self.pipe_sizes[fd] -= n
+
+    def __splice(self, src, dst):
+        '''
+        使用splice将数据从src经管道转发至dst，数据不拷贝到用户态
+
+        参数：src 可读的套接字
+        参数：dst 目标套接字
+        返回：最后一次读取的数据量，0表示src已读到EOF，None表示暂无数据
+        '''
+        fd = dst.fileno()
+        corked = False
+        try:
+            while True:
+                try:
+                    n = os.splice(src.fileno(), self.pipes[fd][1], self.socket_recv_bufsize, flags=_SPLICE_FLAGS)
+                except BlockingIOError:
+                    return None
+                self.pipe_sizes[fd] = n # 仅在对端无待发送数据时读取，此前管道为空
+                self.__flush(dst)
+                if n < self.socket_recv_bufsize or self.pipe_sizes[fd]:
+                    return n # 内核接收队列已读空，或对端暂不可写
+                if not corked:
+                    corked = self.__cork(dst, True)
+        finally:
+            if corked:
+                self.__cork(dst, False)
+
+    def __relay(self, src, dst):
+        '''
+        使用recv_into将数据读入共用的预分配缓冲区后发往dst，不为每次接收分配新的bytes对象
+        连续读取直到src暂无数据或dst暂不可写，减少一次就绪事件后的select调用
+
+        参数：src 可读的套接字
+        参数：dst 目标套接字
+        返回：最后一次读取的数据量，0表示src已读到EOF，None表示暂无数据
+        '''
+        buf, mv = self.recv_buffer, self.recv_view
+        corked = False
+        try:
+            while True:
+                try:
+                    n = src.recv_into(buf)
+                except BlockingIOError:
+                    return None
+                if n == 0:
+                    return 0
+                self.__write(dst, mv[:n]) # 未发出的部分会拷贝到发送缓冲区，buf可立即复用
+                if n < len(buf) or self.send_buffers[dst.fileno()]:
+                    return n # 内核接收队列已读空，或对端暂不可写
+                if not corked:
+                    corked = self.__cork(dst, True)
+        finally:
+            if corked:
+                self.__cork(dst, False)
+
+    def __cork(self, sock, on):
+        '''
+        设置TCP_CORK：一次就绪事件中连续转发多个满缓冲区的数据时，先塞住套接字，
+        使各段数据的尾部合并为完整的报文段，结束时取消以立即发出剩余数据
+
+        参数：sock 目标套接字
+        参数：on 是否塞住
+        返回：是否设置成功
+        '''
+        if _TCP_CORK is None or sock.fileno() in self.connecting:
+            return False
+        sock.setsockopt(socket.IPPROTO_TCP, _TCP_CORK, 1 if on else 0)
+        return True
+
+    def __pending(self, fd):
+        '''
+        是否还有等待发往该套接字的数据
+
+        参数：fd 套接字文件描述符
+        '''
+        return bool(self.send_buffers[fd]) or self.pipe_sizes.get(fd, 0) > 0
+
+    def __update(self, sock):
+        '''
+        根据发送缓冲区状态调整一对套接字所关注的事件，数据转发完毕后关闭
+
+        参数：sock 套接字对中的任一套接字
+        '''
+        fd = sock.fileno()
+        peer = self.socket_peers[fd]
+        peer_fd = peer.fileno()
+        # 每个fd的状态只查询一次
+        eof, peer_eof = fd in self.socket_eof, peer_fd in self.socket_eof
+        pending, peer_pending = self.__pending(fd), self.__pending(peer_fd)
+
+        # 一方已读到EOF，且其数据已全部发往对端，则关闭连接
+        if (eof and not peer_pending) or (peer_eof and not pending):
+            self.__close(sock)
+            return
+
+        for src, src_fd, src_eof, src_pending, dst_pending in (
+                (sock, fd, eof, pending, peer_pending), (peer, peer_fd, peer_eof, peer_pending, pending)):
+            if src_fd in self.connecting:
+                self.__watch(src, selectors.EVENT_WRITE) # 连接完成时套接字变为可写
+                continue
+            events = 0
+            # 对端缓冲区清空后才继续读取，避免数据无限堆积
+            if not src_eof and not dst_pending:
+                events |= selectors.EVENT_READ
+            if src_pending:
+                events |= selectors.EVENT_WRITE
+            self.__watch(src, events)
+
+    def __watch(self, sock, events):
+        '''
+        注册、修改或注销套接字所关注的事件
+
+        参数：sock 套接字
+        参数：events 关注的事件，为0时注销
+        '''
+        fd = sock.fileno()
+        registered = self.socket_events.get(fd, 0)
+        if events == registered:
+            return
+        if not events:
+            self.selector.unregister(sock)
+            del self.socket_events[fd]
+            return
+        if registered:
+            self.selector.modify(sock, events, self.__forward)
+        else:
+            self.selector.register(sock, events, self.__forward)
+        self.socket_events[fd] = events
 
-        socket_client.close()
-        socket_server.close()
+    def __close(self, sock):
+        '''
+        关闭套接字，若已与对端配对则一并关闭
+
+        参数：sock 套接字
+        '''
+        peer = self.socket_peers.get(sock.fileno())
+        for tmp_socket in (sock, peer):
+            if tmp_socket is None or tmp_socket.fileno() < 0:
+                continue
+            fd = tmp_socket.fileno()
+            self.socket_peers.pop(fd, None)
+            self.send_buffers.pop(fd, None)
+            self.socket_eof.discard(fd)
+            self.req_buffers.pop(fd, None)
+            self.pipe_sizes.pop(fd, None)
+            self.connecting.pop(fd, None)
+            for pipe_fd in self.pipes.pop(fd, ()):
+                os.close(pipe_fd)
+            self.__watch(tmp_socket, 0)
+            tmp_socket.close()
+
+    def __accept(self, socket_proxy, mask):
+        '''
+        接受客户端连接，等待其请求数据到达
+        一次就绪事件中批量接受已排队的连接，减少select调用次数
+
+        参数：socket_proxy 代理套接字
+        参数：mask 就绪事件
+        '''
+        for _ in range(_ACCEPT_BATCH):
+            try:
+                socket_client = self.client_socket_accept()
+            except BlockingIOError:
+                break # 已无排队的连接
+            except OSError as e:
+                if e.errno in _ACCEPT_BACKOFF_ERRNOS:
+                    raise # 资源耗尽，由事件循环暂停接受连接
+                continue # 单个连接出错（如客户端已中止连接），继续接受其余连接
+            self.selector.register(socket_client, selectors.EVENT_READ, self.handle_client_request)
+            self.socket_events[socket_client.fileno()] = selectors.EVENT_READ
 
     def client_socket_accept(self):
         '''
-        获取已经与代理端建立连接的客户端套接字，如无则阻塞，直到可以获取一个建立连接套接字
+        获取已经与代理端建立连接的客户端套接字
 
-        返回：socket_client 代理端与客户端之间建立的套接字
+        返回：socket_client 代理端与客户端之间建立的非阻塞套接字
         '''
         socket_client, _ = self.socket_proxy.accept()
+        try:
+            self.__setsockopt(socket_client)
+            socket_client.setblocking(False)
+        except Exception:
+            socket_client.close() # 设置失败时关闭已接受的套接字，避免泄露
+            raise
         return socket_client
 
-    def handle_client_request(self, socket_client):
-        try:
-            self.__proxy(socket_client)
-        except:
-            pass
+    def handle_client_request(self, socket_client, mask):
+        '''
+        客户端套接字可读时读取并处理其请求，出错时由事件循环关闭该连接
+
+        参数：socket_client 代理端与客户端之间建立的套接字
+        参数：mask 就绪事件
+        '''
+        self.__proxy(socket_client)
 
     def start(self):
+        '''
+        启动代理，workers大于1时创建多个工作进程，每个进程运行各自的事件循环
+        '''
+        if self.workers == 1:
+            self.__serve()
+            return
+
+        # 由各工作进程重新创建监听套接字，主进程不再接受连接，避免分到主进程的连接无人处理
+        self.socket_proxy.close()
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+        pids = []
+        for i in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                # 工作进程无论如何都在此退出，不能回到调用方代码中继续执行
+                status = 1
+                try:
+                    if cpus:
+                        os.sched_setaffinity(0, {cpus[i % len(cpus)]}) # 每个工作进程绑定一个CPU核
+                    self.selector.close()
+                    self.selector = selectors.DefaultSelector()
+                    self.__listen()
+                    self.__serve()
+                    status = 0
+                except BaseException as e:
+                    debug('error', 'worker %s: %s: %s' % (os.getpid(), type(e).__name__, e))
+                finally:
+                    # os._exit不会刷新标准输出缓冲区，重定向到文件时需先手动刷新，否则日志丢失
+                    try:
+                        sys.stdout.flush()
+                        sys.stderr.flush()
+                    except Exception:
+                        pass
+                    os._exit(status)
+            pids.append(pid)
+
+        signal.signal(signal.SIGTERM, signal.default_int_handler) # 主进程被终止时一并结束工作进程
         try:
-            import _thread as thread # py3
-        except ImportError:
-            import thread # py2
+            for pid in pids:
+                os.waitpid(pid, 0)
+        except KeyboardInterrupt:
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def __serve(self):
+        '''
+        事件循环
+        '''
+        self.selector.register(self.socket_proxy, selectors.EVENT_READ, self.__accept)
         while True:
             try:
-                # self.handle_client_request(self.client_socket_accept())
-                thread.start_new_thread(self.handle_client_request, (self.client_socket_accept(), ))
+                for key, mask in self.selector.select(self.__expire()):
+                    if key.fileobj.fileno() < 0:
+                        continue # 已在本轮中被关闭
+                    try:
+                        key.data(key.fileobj, mask)
+                    except Exception as e:
+                        if key.fileobj is self.socket_proxy:
+                            if getattr(e, 'errno', None) not in _ACCEPT_BACKOFF_ERRNOS:
+                                debug('error', 'accept: %s: %s' % (type(e).__name__, e))
+                                continue # 监听套接字不能关闭，继续接受连接
+                            # 如文件描述符耗尽：监听套接字会持续可读，暂停接受连接，避免空转并刷屏
+                            debug('error', 'accept: %s, retry in %ss' % (e, _ACCEPT_BACKOFF))
+                            self.selector.unregister(self.socket_proxy)
+                            self.accept_resume = time.monotonic() + _ACCEPT_BACKOFF
+                            continue
+                        # 连接被重置、拒绝等网络错误属于正常情况，其余异常（如无法解析的请求）需记录
+                        if not isinstance(e, OSError):
+                            debug('error', '%s: %s' % (type(e).__name__, e))
+                        self.__close(key.fileobj) # 连同对端套接字、管道一起关闭，避免泄露
             except KeyboardInterrupt:
                 break
 
 if __name__ == '__main__':
     # 默认参数
-    host, port, listen, bufsize, delay = '0.0.0.0', 8080, 10, 8, 1
+    host, port, listen, bufsize, sockbuf, workers, fastopen = '0.0.0.0', 8080, socket.SOMAXCONN, 64, 0, 1, False
     
-    import sys, getopt
+    import getopt
     try:
-        opts, _ = getopt.getopt(sys.argv[1:], 'h:p:l:b:d:', ['host=', 'port=', 'listen=', 'bufsize=', 'delay='])        
+        opts, _ = getopt.getopt(sys.argv[1:], 'h:p:l:b:s:w:f', ['host=', 'port=', 'listen=', 'bufsize=', 'sockbuf=', 'workers=', 'fastopen'])        
         for opt, arg in opts:
             if opt in ('-h', '--host'):
                 host = arg
@@ -232,11 +742,15 @@ if __name__ == '__main__':
                 listen = int(arg)
             elif opt in ('-b', '--bufsize'):
                 bufsize = int(arg)
-            elif opt in ('-d', '--delay'):
-                delay = float(arg)
+            elif opt in ('-s', '--sockbuf'):
+                sockbuf = int(arg)
+            elif opt in ('-w', '--workers'):
+                workers = int(arg)
+            elif opt in ('-f', '--fastopen'):
+                fastopen = True
     except:
         debug('error', 'read the readme.md first!')
         sys.exit()
     
     # 启动代理
-    SimpleHttpProxy(host, port, listen, bufsize, delay).start()
+    SimpleHttpProxy(host, port, listen, bufsize, sockbuf=sockbuf, fastopen=fastopen, workers=workers).start()